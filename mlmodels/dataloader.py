@@ -24,14 +24,24 @@ def get_dataset(data_pars):
 """
 #### System utilities
 import os
+import copy
+import operator
+import re
 import sys
 import inspect
-from urllib.parse import urlparse
+import queue
+import hashlib
+import shutil
+import tempfile
+import threading
 import json
+from urllib.parse import urlparse
+from urllib.request import url2pathname
 from importlib import import_module
 import pandas as pd
 import numpy as np
-from collections.abc import MutableMapping
+from collections import OrderedDict
+from collections.abc import MutableMapping, Mapping, Iterator
 from functools import partial
 from pprint import PrettyPrinter as print2
 
@@ -41,8 +51,9 @@ from pprint import PrettyPrinter as print2
 # from cli_code.cli_download import Downloader
 
 
-from sklearn.model_selection import train_test_split
-import cloudpickle as pickle
+from sklearn.model_selection import train_test_split, ShuffleSplit, StratifiedShuffleSplit
+import pickle
+import cloudpickle
 
 
 #########################################################################
@@ -67,31 +78,468 @@ import tensorflow.data
 
 
 VERBOSE = 0 
+SAVE_MAX_BYTES = 1 << 30   ### Multi-array outputs above this size are saved as a folder of .npy
+FIT_CACHE_MAXSIZE = 32     ### Fitted preprocessors kept by cache_fit, least recently used dropped first
+SPLIT_CACHE_MAXSIZE = 32   ### Seeded train / test index pairs kept, least recently used dropped first
 DATASET_TYPES = ["csv_dataset", "text_dataset", "NumpyDataset", "pandasDataset"]
 
 
 
 #########################################################################
 def pickle_load(file):
-    return pickle.load(open(file, " r"))
+    with open(file, "rb") as fi:
+        return pickle.load(fi)
 
 
 def pickle_dump(t, **kwargs):
+    ### Plain data : stdlib pickle, much faster on big buffers. Else cloudpickle (lambdas, local classes)
+    dumper = pickle if isinstance(t, (np.ndarray, pd.DataFrame, pd.Series)) else cloudpickle
     with open(kwargs["path"], "wb") as fi:
-        pickle.dump(t, fi)
+        dumper.dump(t, fi, protocol=pickle.HIGHEST_PROTOCOL)
     return t
 
 
+def pandas_column_names(names):
+    ### Column names as pandas.read_csv builds them : "" --> "Unnamed: i", duplicates a, a --> a, a.1
+    names  = [col if col != "" else f"Unnamed: {i}" for i, col in enumerate(names)]
+    counts = {}
+    out    = []
+    for col in names:
+        base      = col
+        cur_count = counts.get(col, 0)
+        while cur_count > 0:
+            counts[base] = cur_count + 1
+            col = f"{base}.{cur_count}"
+            cur_count = cur_count + 1 if col in names else counts.get(col, 0)
+        counts[col] = cur_count + 1
+        out.append(col)
+    return out
+
+
+def arrow_cast_int_column(col, int_type):
+    ### Integer column read as strings : pyarrow would parse hex "0x10" as 16, pandas keeps the strings.
+    ### Decimal ints --> int_type, then float64 (later blocks with floats), else strings as pandas does.
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    if pc.any(pc.match_substring_regex(col, r"^\s*[+-]?0[xX]")).as_py():
+        return col
+    digits = pc.utf8_trim_whitespace(col)   ### Inference accepts " 3", cast does not
+    for t in (int_type, pa.float64()):
+        try:
+            return pc.cast(digits, t)
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+            pass
+    return col
+
+
+### pandas.read_csv default NA strings, when pandas._libs.parsers.STR_NA_VALUES (private, pandas >= 1.0) is missing
+PANDAS_NA_VALUES = ["", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+                    "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"]
+
+def arrow_read_csv(path, block_size=8 << 20, use_threads=True, to_pandas=True, chunksize=None, **args):
+    """
+      Default .csv loader : multi-threaded pyarrow CSV parser, block_size (bytes) is tunable
+      (best value depends on the number of columns). to_pandas=False keeps the pyarrow Table.
+      Close to pandas.read_csv with default arguments : pandas NA strings, date / time
+      columns and hex numbers ("0x10") kept as strings, all-empty columns as float NaN,
+      column names mangled as pandas does ("Unnamed: 0", "a.1").
+      Column types are inferred from the first block (block_size) : a column that is empty or
+      holds dates / times there but other values later is not converted the way pandas does.
+      Falls back to pandas.read_csv when pyarrow is missing, pandas arguments are given, or
+      chunksize is set (generator mode) : pyarrow streaming fixes column types from the first block only.
+    """
+    try:
+        import pyarrow as pa
+        from pyarrow import csv as pa_csv
+    except ImportError:
+        pa_csv = None
+    if pa_csv is None or args or chunksize is not None:
+        return pd.read_csv(path, chunksize=chunksize, **args)
+
+    try:
+        from pandas._libs.parsers import STR_NA_VALUES
+        na_values = sorted(STR_NA_VALUES)
+    except ImportError:
+        na_values = PANDAS_NA_VALUES
+
+    def convert_options(column_types=None):
+        return pa_csv.ConvertOptions(null_values=na_values, strings_can_be_null=True,
+                                     quoted_strings_can_be_null=True, timestamp_parsers=[],
+                                     column_types=column_types)
+
+    ### Header and column types from the first block only, then a single full parse.
+    ### pyarrow infers ISO dates / timestamps / times, pandas keeps them as strings.
+    ### Integer columns are read as strings, then cast : pyarrow also parses hex ints.
+    schema  = pa_csv.open_csv(path, read_options=pa_csv.ReadOptions(block_size=block_size),
+                              convert_options=convert_options()).schema
+    if any("\n" in name or "\r" in name for name in schema.names):
+        ### Quoted header over several lines : skip_rows below skips one line, not one record
+        df = pd.read_csv(path)
+        return df if to_pandas else pa.Table.from_pandas(df, preserve_index=False)
+    names   = pandas_column_names(schema.names)
+    strings = {name: pa.string() for name, f in zip(names, schema)
+               if pa.types.is_date(f.type) or pa.types.is_timestamp(f.type) or pa.types.is_time(f.type)}
+    ints    = {name: f.type for name, f in zip(names, schema) if pa.types.is_integer(f.type)}
+
+    read_options = pa_csv.ReadOptions(block_size=block_size, use_threads=use_threads,
+                                      column_names=names, skip_rows=1)
+    table = pa_csv.read_csv(path, read_options=read_options,
+                            convert_options=convert_options({**strings, **{name: pa.string() for name in ints}}))
+
+    for i, f in enumerate(table.schema):
+        if f.name in ints:
+            table = table.set_column(i, f.name, arrow_cast_int_column(table.column(i), ints[f.name]))
+        elif pa.types.is_null(f.type):
+            ### All-empty column : float NaN as in pandas, not object None
+            table = table.set_column(i, f.name, table.column(i).cast(pa.float64()))
+    return table.to_pandas() if to_pandas else table
+
+
+def npy_dir_load(path, mmap_mode="c"):
+    ### Folder of .npy files (see save_arrays) --> dict of memory-mapped arrays, in natural order arr_2 < arr_10
+    files = [f for f in os.listdir(path) if f.endswith(".npy")]
+    files = sorted(files, key=lambda f: [int(t) if t.isdigit() else t for t in re.split(r"(\d+)", f)])
+    return {os.path.splitext(f)[0]: np.load(os.path.join(path, f), mmap_mode=mmap_mode) for f in files}
+
+
+def download_file(url, out_path="./"):
+    """
+      Download url into its own sub-folder of out_path, named from a hash of the url :
+      same file name from two URLs (http://a/x/data.csv, http://b/y/data.csv) never shares a path.
+      Downloader names the file from the Content-Disposition header, else from the URL path.
+      A finished download of the same url is reused : delete its folder to download again.
+    """
+    from cli_code.cli_download import Downloader
+    folder = os.path.join(out_path, hashlib.blake2b(url.encode(), digest_size=8).hexdigest())
+    os.makedirs(folder, exist_ok=True)
+    done = [f for f in os.listdir(folder) if os.path.isfile(os.path.join(folder, f))]
+    if done:
+        return os.path.join(folder, done[0])
+
+    ### Downloaded into a temp folder, then moved in place : loaders fetching the same url
+    ### at the same time never see a partial file, the last os.replace wins
+    tmp_dir = tempfile.mkdtemp(prefix=".download-", dir=folder)
+    try:
+        Downloader(url).download(tmp_dir)
+        files = os.listdir(tmp_dir)
+        if len(files) != 1:
+            raise Exception(f"Download of {url} failed : no file saved in {folder}")
+        file_path = os.path.join(folder, files[0])
+        os.replace(os.path.join(tmp_dir, files[0]), file_path)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return file_path
+
+
 def image_dir_load(path):
+    from tensorflow.keras.preprocessing.image import ImageDataGenerator
     return ImageDataGenerator().flow_from_directory(path)
 
 
+class LazyNpz(Mapping):
+    """
+      Dict-like view on a .npz archive, also indexable by position.
+      NpzFile is already lazy : arrays are read/decompressed on access, unused ones never are.
+    """
+    def __init__(self, npz):
+        self._npz = npz
+
+    def __getitem__(self, key):
+        if not isinstance(key, str):
+            key = self._npz.files[operator.index(key)]
+        return self._npz[key]
+
+    def __iter__(self):
+        return iter(self._npz.files)
+
+    def __len__(self):
+        return len(self._npz.files)
+
+
+URL_PREFIXES    = ("http://", "https://")                   ### Downloaded by download_file (cli_code Downloader)
+REMOTE_PREFIXES = ("ftp://", "s3://", "gs://", "hdfs://")   ### No downloader : rejected, not read as local paths
+
+def is_url(path):
+    ### String prefix check : no urlparse, no filesystem stat for local paths
+    return isinstance(path, str) and path.startswith(URL_PREFIXES)
+
+
+def local_path(path):
+    ### file:// URL --> local path. Other strings are local paths, except remote schemes without downloader
+    if path.startswith("file://"):
+        return url2pathname(urlparse(path).path)
+    if path.startswith(REMOTE_PREFIXES):
+        raise Exception(f"URL scheme not supported by the loader, download the file first : {path}")
+    return path
+
+
+def is_chunk_iterator(x):
+    ### Lazy chunk source (pd.read_csv(chunksize=), generator), not an in-memory container
+    return isinstance(x, Iterator)
+
+
+def slice_rows(a, start, end):
+    ### Row slice of one output : positional for pandas (.iloc), plain slice otherwise
+    return a.iloc[start:end] if hasattr(a, "iloc") else a[start:end]
+
+
 def batch_generator(iterable, n=1):
+    if isinstance(iterable, tuple) and len(iterable) > 0:
+        ### Tuple of outputs (SoA) : one tuple of per-output row slices per batch, no per-sample copy
+        l = len(iterable[0])
+        if all(isinstance(a, np.ndarray) for a in iterable):
+            for ndx in range(0, l, n):
+                yield tuple(a[ndx : min(ndx + n, l)] for a in iterable)
+        else:
+            for ndx in range(0, l, n):
+                yield tuple(slice_rows(a, ndx, min(ndx + n, l)) for a in iterable)
+        return
+
     l = len(iterable)
     for ndx in range(0, l, n):
         yield iterable[ndx : min(ndx + n, l)]
 
 
+class PrefetchGenerator:
+    """
+      Run a generator in a background thread, keeping up to prefetch items ready :
+      batch N+1 is built while batch N is consumed by the training loop.
+      close() (or garbage collection) stops the thread when the consumer breaks early.
+    """
+    _end = object()
+
+    def __init__(self, generator, prefetch=2):
+        self._queue  = queue.Queue(maxsize=max(int(prefetch), 1))
+        self._stop   = threading.Event()
+        self._error  = []
+        ### Thread target holds no reference to self : __del__ can run while the thread waits
+        self._thread = threading.Thread(target=self._run, args=(generator, self._queue, self._stop, self._error),
+                                        daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _put(q, stop, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    @staticmethod
+    def _run(generator, q, stop, error):
+        try:
+            for item in generator:
+                if not PrefetchGenerator._put(q, stop, item):
+                    return
+        except Exception as e:
+            error.append(e)
+        finally:
+            PrefetchGenerator._put(q, stop, PrefetchGenerator._end)
+
+    def close(self):
+        self._stop.set()
+        while True:   ### Drop prefetched items, they can be large
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        self._thread.join(timeout=1.0)
+
+    def __del__(self):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._stop.is_set():
+            raise StopIteration
+        item = self._queue.get()
+        if item is self._end:
+            self._queue.put(self._end)  ### Keep raising StopIteration on next calls
+            if self._error:
+                raise self._error.pop()
+            raise StopIteration
+        return item
+
+
+_split_indices_cache = OrderedDict()
+
+def _compute_split_indices(n, test_size, labels=None, random_state=None):
+    ### Int-seeded splits are deterministic : indices are cached, computed once for all the arrays/folds.
+    ### A RandomState instance gives a new split on each call, as in train_test_split : not cached.
+    key = None
+    if isinstance(random_state, (int, np.integer)) and (labels is None or labels.dtype != object):
+        key = (n, test_size, int(random_state), None if labels is None else hash(np.ascontiguousarray(labels).tobytes()))
+        if key in _split_indices_cache:
+            _split_indices_cache.move_to_end(key)
+            return _split_indices_cache[key]
+
+    splitter = StratifiedShuffleSplit if labels is not None else ShuffleSplit
+    splitter = splitter(n_splits=1, test_size=test_size, random_state=random_state)
+    train_idx, test_idx = next(splitter.split(np.zeros(n), labels))
+
+    if key is not None:
+        ### Same arrays returned to every caller : read-only, so one caller cannot change later splits
+        train_idx.flags.writeable = False
+        test_idx.flags.writeable  = False
+        _split_indices_cache[key] = (train_idx, test_idx)
+        while len(_split_indices_cache) > SPLIT_CACHE_MAXSIZE:
+            _split_indices_cache.popitem(last=False)
+    return train_idx, test_idx
+
+
+def take_rows(a, idx):
+    ### Same row indexing as train_test_split : DataFrame / Series by position, arrays, sparse matrices, lists
+    if hasattr(a, "iloc"):
+        return a.iloc[idx]
+    if hasattr(a, "tocsr"):
+        return (a if a.format in ("csr", "csc") else a.tocsr())[idx]   ### coo, dia... have no row indexing
+    if hasattr(a, "shape"):
+        return a[idx]
+    return [a[i] for i in idx]
+
+
+def _apply_split_indices(arrays, train_idx, test_idx):
+    out = []
+    for a in arrays:
+        out.extend((take_rows(a, train_idx), take_rows(a, test_idx)))
+    return tuple(out)
+
+
+def split_train_test(*arrays, test_size=0.25, stratify=None, random_state=None):
+    """
+      Preprocessor stage, same output as train_test_split : (a_train, a_test, b_train, b_test, ...)
+      Train / test indices are computed once, then applied to each array.
+      stratify : class labels (array-like, as in train_test_split), or position of the
+                 label array in arrays (True : last one),
+                 split keeps the class balance with StratifiedShuffleSplit.
+    """
+    labels = None
+    if stratify is True:
+        labels = np.asarray(arrays[-1])
+    elif isinstance(stratify, (int, np.integer)) and not isinstance(stratify, bool):
+        labels = np.asarray(arrays[stratify])
+    elif stratify is not None and stratify is not False:
+        labels = np.asarray(stratify)
+
+    train_idx, test_idx = _compute_split_indices(len(arrays[0]), test_size, labels, random_state)
+    return _apply_split_indices(arrays, train_idx, test_idx)
+
+
+_fit_cache = OrderedDict()
+
+def fit_cache_get(key):
+    if key is None or key not in _fit_cache:
+        return None
+    _fit_cache.move_to_end(key)
+    return _fit_cache[key]
+
+
+def _n_rows(data):
+    ### Row count of an array / DataFrame (first element of a tuple / list), None otherwise
+    if isinstance(data, (tuple, list)) and data:
+        data = data[0]
+    if isinstance(data, (np.ndarray, pd.DataFrame, pd.Series)) and data.ndim > 0:
+        return len(data)
+    return None
+
+
+def _is_row_data(v, n_rows):
+    ### Per-row data (input, transformed copies, (X, y) tuples...), not fitted state
+    if isinstance(v, (tuple, list)):
+        return len(v) > 0 and all(_is_row_data(x, n_rows) for x in v)
+    if isinstance(v, dict):
+        return len(v) > 0 and all(_is_row_data(x, n_rows) for x in v.values())
+    return isinstance(v, (np.ndarray, pd.DataFrame, pd.Series)) and v.ndim > 0 and len(v) == n_rows
+
+
+def _same_data(a, b):
+    if isinstance(a, (tuple, list)):
+        return isinstance(b, (tuple, list)) and len(a) == len(b) and all(_same_data(x, y) for x, y in zip(a, b))
+    if isinstance(a, dict):
+        return isinstance(b, dict) and a.keys() == b.keys() and all(_same_data(a[k], b[k]) for k in a)
+    if isinstance(a, (pd.DataFrame, pd.Series)):
+        return isinstance(b, type(a)) and a.equals(b)
+    if isinstance(a, np.ndarray):
+        if not isinstance(b, np.ndarray) or a.shape != b.shape:
+            return False
+        try:
+            return np.array_equal(a, b, equal_nan=True)
+        except TypeError:   ### equal_nan : numpy >= 1.19 and numeric dtypes only
+            return bool(np.array_equal(a, b))
+    try:
+        return bool(a == b)
+    except Exception:
+        return False
+
+
+def fit_cache_put(key, obj, data, out):
+    ### Contract of a cache_fit stage : compute(data) fits, then transform(data) gives back get_data().
+    ### The cached copy drops the per-row data the stage holds (get_data() output, transformed copies...),
+    ### only the fitted state stays in RAM. Checked once, on the copy : not cached if transform() differs.
+    obj    = copy.copy(obj)
+    n_rows = _n_rows(data)
+    if hasattr(obj, "__dict__"):
+        for k in [k for k, v in vars(obj).items() if v is out or (n_rows is not None and _is_row_data(v, n_rows))]:
+            delattr(obj, k)
+
+    try:
+        same = _same_data(obj.transform(data), out)
+    except Exception as e:
+        log("cache_fit :", type(obj).__name__, "transform() failed :", e)
+        same = False
+    if not same:
+        log("cache_fit :", type(obj).__name__, "transform() does not match get_data(), fitted object not cached")
+        return False
+
+    _fit_cache[key] = obj
+    _fit_cache.move_to_end(key)
+    while len(_fit_cache) > FIT_CACHE_MAXSIZE:
+        _fit_cache.popitem(last=False)
+    return True
+
+
+def data_digest(data, sample_bytes=1 << 20):
+    ### Hash of shapes + first sample_bytes of each array / DataFrame, None if not hashable this way
+    try:
+        import xxhash
+        h = xxhash.xxh64()
+    except ImportError:
+        h = hashlib.blake2b(digest_size=16)
+
+    for x in (data if isinstance(data, (tuple, list)) else (data,)):
+        if isinstance(x, (pd.DataFrame, pd.Series)):
+            columns = list(x.columns) if isinstance(x, pd.DataFrame) else [x.name]
+            if not columns:
+                return None
+            n_rows  = max(sample_bytes // (8 * len(columns)), 1)
+            h.update(str((x.shape, columns)).encode())
+            try:
+                h.update(pd.util.hash_pandas_object(x.head(n_rows), index=False).values.tobytes())
+            except TypeError:   ### Unhashable cells (lists, dicts...)
+                return None
+        elif isinstance(x, np.ndarray) and x.dtype != object:
+            h.update(str((x.shape, x.dtype.str)).encode())
+            ### First rows only, before flattening : a non-contiguous array would be copied in full
+            row_bytes = x.itemsize * int(np.prod(x.shape[1:])) if x.ndim > 0 else x.itemsize
+            head      = x[: max(sample_bytes // max(row_bytes, 1), 1)] if x.ndim > 0 else x
+            h.update(np.ascontiguousarray(head.reshape(-1)[: sample_bytes // x.itemsize]).tobytes())
+        else:
+            return None
+    return h.hexdigest()
+
+
+def fit_cache_key(uri, args, data):
+    ### Same preprocessor spec fitted on the same data (sample) : fitted object is reused, transform() only
+    digest = data_digest(data)
+    if digest is None:
+        return None
+    return (uri, json.dumps(args, sort_keys=True, default=str), digest)
+
+
 def _validate_data_info(self, data_info):
     dataset = data_info.get("dataset", None)
     if not dataset:
@@ -114,54 +562,396 @@ def _validate_data_info(self, data_info):
     self.col_miscinput = data_info.get("col_miscinput", None)
 
 
-def _check_output_shape(self, inter_output, shape, max_len):
+def get_output_case(inter_output):
+    # case 0: non-tuple, non-dict: single output from the preprocessor/loader.
+    # case 1: tuple of non-dicts: multiple outputs from the preprocessor/loader.
+    # case 2: tuple of dicts: multiple args from the preprocessor/loader.
+    # case 3: dict of non-dicts: multiple named outputs from the preprocessor/loader.
+    # case 4: dict of dicts: multiple named dictionary outputs from the preprocessor. (Special case)
     case = 0
     if isinstance(inter_output, tuple):
-        if not isinstance(inter_output[0], dict):
+        if not isinstance(inter_output[0], Mapping):
             case = 1
         else:
             case = 2
-    if isinstance(inter_output, dict):
-        if not isinstance(tuple(inter_output.values())[0], dict):
+    if isinstance(inter_output, Mapping):
+        if not isinstance(next(iter(inter_output.values())), Mapping):
             case = 3
         else:
             case = 4
-    # max_len enforcement
-    if max_len is not None:
-        try:
-            if case == 0:
-                inter_output = inter_output[0:max_len]
-            if case == 1:
-                inter_output = [o[0:max_len] for o in inter_output]
-            if case == 3:
-                inter_output = {
-                    k: v[0:max_len] for k, v in inter_output.items()
-                }
-        except:
-            pass
-    # shape check
-    if shape is not None:
-        if (
-            case == 0
-            and hasattr(inter_output, "shape")
-            and tuple(shape) != inter_output.shape
-        ):
-            raise Exception(f"Expected shape {tuple(shape)} does not match  {inter_output.shape[1:]}")
+    return case
 
-        if case == 1:
-            for s, o in zip(shape, inter_output):
-                if hasattr(o, "shape") and tuple(s) != o.shape[1:]:
-                    raise Exception(f"Expected shape {tuple(shape)} does not match  {inter_output.shape[1:]}")
 
-        if case == 3:
-            for s, o in zip(shape, tuple(inter_output.values())):
-                if hasattr(o, "shape") and tuple(s) != o.shape[1:]:
-                    raise Exception(f"Expected shape {tuple(shape)} does not match  {inter_output.shape[1:]}")
+class _NestedOutput:
+    """ case 2 / 4 : nested dicts, passed as is, no framework conversion. """
+    def items(self, out):
+        return []
+
+    def rebuild(self, out, leaves):
+        return out
+
+    def values(self, out):
+        raise Exception("Input format not supported for the specified output format")
+
+
+class _SingleOutput(_NestedOutput):
+    """ case 0 : single array/DataFrame, shape is checked in full. """
+    def items(self, out):
+        return [(None, out)]
+
+    def rebuild(self, out, leaves):
+        return leaves[0]
+
+    def expected_shape(self, shape, i):
+        return tuple(shape)
+
+    def leaf_shape(self, leaf):
+        return leaf.shape
+
+    def values(self, out):
+        return (out,)
+
+
+class _TupleOutput(_SingleOutput):
+    """ case 1 : tuple of arrays, shape is checked per sample (without first dim). """
+    def items(self, out):
+        return list(enumerate(out))
+
+    def rebuild(self, out, leaves):
+        return tuple(leaves)
+
+    def expected_shape(self, shape, i):
+        return tuple(shape[i]) if i < len(shape) else None
+
+    def leaf_shape(self, leaf):
+        return leaf.shape[1:]
+
+    def values(self, out):
+        return out
+
+
+class _DictOutput(_TupleOutput):
+    """ case 3 : dict of arrays, handled as the tuple of its values. """
+    def items(self, out):
+        return list(out.items())
+
+    def rebuild(self, out, leaves):
+        return dict(zip(out.keys(), leaves))
+
+    def values(self, out):
+        return tuple(out.values())
+
+
+_CASE_HANDLERS = {0: _SingleOutput(), 1: _TupleOutput(), 2: _NestedOutput(), 3: _DictOutput(), 4: _NestedOutput()}
+
+
+def save_output(x, path, save_format="auto"):
+    if isinstance(x, np.ndarray):
+        np.save(path, x)
+    elif isinstance(x, pd.DataFrame):
+        x.to_csv(path)
+    elif isinstance(x, tuple) and all(isinstance(a, np.ndarray) for a in x):
+        save_arrays({f"arr_{i}": a for i, a in enumerate(x)}, path, save_format)
+    elif isinstance(x, Mapping) and all(isinstance(a, np.ndarray) for a in x.values()):
+        save_arrays(x, path, save_format)
+    else:
+        pickle_dump(x, path=path)
+
+
+def savez_arrays(arrays, path):
+    ### Same archive as np.savez, any key : np.savez(path, **arrays) fails on non-str keys and on "file"
+    import zipfile
+    path = path if str(path).endswith(".npz") else f"{path}.npz"
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_STORED, allowZip64=True) as zf:
+        for k, a in arrays.items():
+            with zf.open(f"{k}.npy", "w", force_zip64=True) as f:
+                np.lib.format.write_array(f, np.asanyarray(a), allow_pickle=True)
+
+
+def save_arrays(arrays, path, save_format="auto"):
+    """
+      Multi-array outputs, from the "save_format" output option :
+        "npz"     : single .npz archive at path.
+        "npy_dir" : folder path (without extension), one .npy per array written one at a time,
+                    reloaded memory-mapped by npy_dir_load.
+        "auto"    : "npy_dir" above SAVE_MAX_BYTES, else "npz". The location is logged.
+    """
+    if save_format == "auto":
+        save_format = "npz" if sum(a.nbytes for a in arrays.values()) <= SAVE_MAX_BYTES else "npy_dir"
+    if save_format == "npz":
+        savez_arrays(arrays, path)
+        return
+    if save_format != "npy_dir":
+        raise Exception(f"Unknown save_format {save_format}")
+
+    path = os.path.splitext(path)[0]
+    log(f"Saving outputs as a folder of .npy files : {path}")
+    os.makedirs(path, exist_ok=True)
+    for k, a in arrays.items():
+        np.save(os.path.join(path, f"{k}.npy"), a)
+
+
+def check_float_dtype(dtype):
+    ### Output dtype only narrows float arrays : "float16", "float32", "bfloat16"
+    if dtype == "bfloat16":
+        return dtype
+    if not np.issubdtype(np.dtype(dtype), np.floating):
+        raise Exception(f"Output dtype must be a floating type, got {dtype}")
+    return dtype
+
+
+def smallest_int_type(a):
+    ### Smallest int type of the same signedness holding the array min / max
+    types = (np.int8, np.int16, np.int32, np.int64) if np.issubdtype(a.dtype, np.signedinteger) else \
+            (np.uint8, np.uint16, np.uint32, np.uint64)
+    lo, hi = a.min(), a.max()
+    for t in types:
+        if np.iinfo(t).min <= lo and hi <= np.iinfo(t).max:
+            return t
+    return a.dtype
+
+
+def downcast_array(a, dtype, label=False):
+    ### float arrays --> dtype ("float16", "bfloat16" needs ml_dtypes),
+    ### int arrays of label outputs --> smallest int type holding their min / max.
+    ### Memory-mapped arrays (.npy loader) are cast too, into an in-RAM copy : trim with out_max_len first.
+    if not isinstance(a, np.ndarray):
+        log(f"Output dtype {dtype} not applied to {type(a).__name__}, numpy arrays only")
+        return a
+    if a.size == 0:
+        return a
+    if isinstance(a, np.memmap):
+        a = np.asarray(a)   ### Plain ndarray view : astype gives an in-RAM array, not a file-less memmap
+    if np.issubdtype(a.dtype, np.floating):
+        if dtype == "bfloat16":
+            import ml_dtypes
+            dtype = ml_dtypes.bfloat16
+        return a.astype(dtype, copy=False)
+    if label and np.issubdtype(a.dtype, np.integer):
+        return a.astype(smallest_int_type(a), copy=False)
+    return a
+
+
+def _check_output_shape(self, inter_output, shape, max_len, case=None, path=None, dtype=None, label_outputs=None,
+                        save_format="auto"):
+    """
+      One pass over the outputs (leaves) : out_max_len trim, dtype downcast, shape check,
+      then save when path is a list (one path per output). A single path saves the whole output.
+      label_outputs : keys / positions of the int label outputs also downcast with dtype.
+    """
+    handler = _CASE_HANDLERS[get_output_case(inter_output) if case is None else case]
+    items   = handler.items(inter_output)
+    paths   = path if isinstance(path, list) else []
+    leaves  = []
+    labels  = label_outputs or []
+    if dtype is not None:
+        dtype = check_float_dtype(dtype)
+
+    for i, (key, leaf) in enumerate(items):
+        # max_len enforcement
+        if max_len is not None:
+            try:
+                leaf = leaf[0:max_len]
+            except:
+                pass
+
+        # Narrower dtype : less bytes to save / copy to tf, torch
+        if dtype is not None:
+            leaf = downcast_array(leaf, dtype, label=(key if key is not None else i) in labels)
+
+        # shape check : plain tuple compare per leaf. Packing the shapes into int arrays for a
+        # vectorized / numba check is itself a Python loop, ~10x slower at 10k outputs.
+        expected = handler.expected_shape(shape, i) if shape is not None else None
+        if expected is not None and hasattr(leaf, "shape") and expected != handler.leaf_shape(leaf):
+            raise Exception(f"Expected shape {expected} does not match  {handler.leaf_shape(leaf)}")
+
+        leaves.append(leaf)
+
+    ### Saved once all the leaves are checked : no partial files on a shape mismatch
+    for leaf, leaf_path in zip(leaves, paths):
+        save_output(leaf, leaf_path, save_format)
+
+    inter_output = handler.rebuild(inter_output, leaves)
+    if isinstance(path, str):
+        save_output(inter_output, path, save_format)
 
     self.output_shape = shape
     return inter_output
 
 
+def output_nbytes(a):
+    ### In-memory size of one output : DataFrame / Series have no .nbytes
+    if isinstance(a, pd.DataFrame):
+        return int(a.memory_usage(index=False).sum())
+    if isinstance(a, pd.Series):
+        return int(a.memory_usage(index=False))
+    return getattr(a, "nbytes", 0)
+
+
+def to_torch_tensor(a, pin_memory=False):
+    """
+      numpy -> torch without copy (torch.from_numpy shares the buffer).
+      pin_memory : page-locked tensor, so that the training loop can overlap the
+      host to GPU copy with compute, using x.to(device, non_blocking=True).
+      Copy-on-write memory-mapped arrays (.npy loader) are never pinned, read-only ones are copied.
+    """
+    import torch
+    if isinstance(a, np.ndarray) and a.dtype.name == "bfloat16":
+        ### ml_dtypes.bfloat16 (output dtype "bfloat16") is unknown to torch.from_numpy : same bits as torch.bfloat16
+        return to_torch_tensor(a.view(np.uint16), pin_memory).view(torch.bfloat16)
+
+    if isinstance(a, np.memmap) and a.flags.writeable:
+        ### Copy-on-write mapping (mmap_mode="c") : in-place ops never reach the file, pages are
+        ### loaded lazily by the DataLoader workers. Pinning would read the whole file in RAM.
+        return torch.from_numpy(np.ascontiguousarray(a))
+
+    if isinstance(a, np.ndarray) and not a.flags.writeable:
+        ### Read-only buffer (user-given mmap_mode="r", DataFrame.values with copy-on-write) : an in-place
+        ### op on a tensor sharing it crashes the process, torch gets a writable in-RAM copy
+        a = np.array(a)
+    t = torch.from_numpy(np.ascontiguousarray(a)) if isinstance(a, np.ndarray) else torch.as_tensor(np.asarray(a))
+    return t.pin_memory() if pin_memory else t
+
+
+def tf_from_generator(generator, sample):
+    """
+      tf.data.Dataset over the batches of generator(), dtypes / shapes from sample (array or
+      tuple of arrays), first dim left free. output_types / output_shapes work on TF 1.15 and 2.x,
+      output_signature only exists from TF 2.4.
+    """
+    import tensorflow as tf
+    def dtype_shape(a):
+        return tf.as_dtype(a.dtype), tf.TensorShape((None,) + a.shape[1:])
+
+    if isinstance(sample, tuple):
+        types, shapes = tuple(zip(*(dtype_shape(a) for a in sample)))
+    else:
+        types, shapes = dtype_shape(sample)
+    return tf.data.Dataset.from_generator(generator, output_types=types, output_shapes=shapes)
+
+
+def _interpret_output(self, output, inter_output):
+    """
+      Framework-specific output formatting, from the "output" key of data_pars :
+        "output" : { "format" : "generic_generator" / "tfDataset" / "tchDataset" / "tchDataLoader",
+                     "shape" : [...], "out_max_len" : 1000, "path" : "out.npz" or [...], "save_format" : "auto",
+                     "dtype" : "float16", "label_outputs" : [1], "prefetch" : 2, "num_workers" : 0, "raw_mmap" : False,
+                     "cache" : False, "tf_max_bytes" : 1 << 30 }
+    """
+    if is_chunk_iterator(inter_output):
+        return self._interpret_stream_output(output, inter_output)
+
+    if output.get("raw_mmap", False) and output.get("dtype", None):
+        raise Exception("Output options raw_mmap and dtype cannot be combined : dtype casts the mapped arrays in RAM")
+
+    ### Case is resolved once, the handler does trim / shape check / save / conversion
+    case          = get_output_case(inter_output)
+    handler       = _CASE_HANDLERS[case]
+    inter_output  = self._check_output_shape(inter_output, output.get("shape", None), output.get("out_max_len", None),
+                                             case, output.get("path", None), output.get("dtype", None),
+                                             output.get("label_outputs", None), output.get("save_format", "auto"))
+    output_format = output.get("format", None)
+    if output_format is None:
+        return inter_output
+
+    ### Outputs as a tuple, built once for all the formats. payload : what is batched / sliced
+    values  = handler.values(inter_output)
+    payload = inter_output if case == 0 else values
+
+    if output.get("raw_mmap", False) and all(isinstance(a, np.memmap) for a in values):
+        ### Memory-mapped arrays returned untouched, for direct mmap --> GPU copy by the trainer (cupy.asarray, ...)
+        return inter_output
+
+
+    if output_format == "generic_generator":
+        ### Multiple outputs are already SoA : batches are tuples of array views
+        gen = batch_generator(payload, self.batch_size)
+        return PrefetchGenerator(gen, prefetch=output.get("prefetch", 2))
+
+
+    if output_format == "tfDataset":
+        import tensorflow as tf
+        if sum(output_nbytes(a) for a in values) > output.get("tf_max_bytes", 1 << 30):
+            ### Big arrays : stream batches, from_tensor_slices would copy them into a graph constant (2GB limit)
+            arrays  = tuple(a.to_numpy() if isinstance(a, (pd.DataFrame, pd.Series)) else np.asarray(a) for a in values)
+            arrays  = arrays if case != 0 else arrays[0]
+            dataset = tf_from_generator(lambda: batch_generator(arrays, self.batch_size), arrays)
+        else:
+            dataset = tf.data.Dataset.from_tensor_slices(payload)
+            if output.get("cache", False):
+                dataset = dataset.cache()
+            dataset = dataset.batch(self.batch_size)
+        ### prefetch goes last, after batch
+        return dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+
+    if output_format in ("tchDataset", "tchDataLoader"):
+        import torch
+        pin_memory = torch.cuda.is_available()
+        if output_format == "tchDataset":
+            ### Tensors pinned up-front : the trainer indexes the dataset itself
+            return torch.utils.data.TensorDataset(*(to_torch_tensor(a, pin_memory) for a in values))
+
+        ### DataLoader pins each collated batch (pin_memory=True), tensors stay pageable
+        dataset = torch.utils.data.TensorDataset(*(to_torch_tensor(a) for a in values))
+
+        num_workers = output.get("num_workers", 0)
+        loader_args = {"batch_size": self.batch_size, "num_workers": num_workers, "pin_memory": pin_memory}
+        if num_workers > 0:
+            ### prefetch_factor / persistent_workers : torch >= 1.7 only
+            worker_args = {"prefetch_factor": output.get("prefetch", 2), "persistent_workers": True}
+            params      = inspect.signature(torch.utils.data.DataLoader).parameters
+            loader_args.update({k: v for k, v in worker_args.items() if k in params})
+        return torch.utils.data.DataLoader(dataset, **loader_args)
+
+    raise Exception(f"Unknown output format {output_format}")
+
+
+def _interpret_stream_output(self, output, chunks):
+    """
+      Streamed output (generator mode) : chunks are already batches of batch_size rows,
+      no trim / shape check / save / batching. Only generic_generator and tfDataset can stream.
+    """
+    for key in ("out_max_len", "shape", "path", "dtype", "raw_mmap"):
+        if output.get(key, None):
+            raise Exception(f"Output option '{key}' is not supported on streamed (generator mode) output")
+
+    output_format = output.get("format", None)
+    if output_format is None:
+        return chunks
+
+    if output_format == "generic_generator":
+        return PrefetchGenerator(chunks, prefetch=output.get("prefetch", 2))
+
+    if output_format == "tfDataset":
+        import tensorflow as tf
+        ### Signature from the first chunk, then the first chunk is yielded back before the others
+        def to_numpy(chunk):
+            return tuple(np.asarray(a) for a in chunk) if isinstance(chunk, tuple) else np.asarray(chunk)
+
+        first = to_numpy(next(chunks))
+
+        ### from_generator calls stream() once per epoch : the first epoch uses the stream opened
+        ### by compute(), the next ones re-open the pipeline (one-shot chunk iterators)
+        opened = [chunks]
+        def stream():
+            if opened:
+                source = opened.pop()
+                yield first
+            else:
+                source = self._run_preprocessors()
+            for chunk in source:
+                yield to_numpy(chunk)
+
+        dataset = tf_from_generator(stream, first)
+        return dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+    if output_format in ("tchDataset", "tchDataLoader"):
+        raise Exception(f"Output format {output_format} needs in-memory data, it cannot be used in generator mode")
+
+    raise Exception(f"Unknown output format {output_format}")
+
+
 
 def get_dataset_type(x) :
     from mlmodel.process.generic import PandasDataset, NumpyDataset, Dataset, kerasDataset  #Pytorch
@@ -222,21 +1012,29 @@ data_pars --> Dataloader.py  :
 class DataLoader:
 
     default_loaders = {
-        ".csv": {"uri": "pandas::read_csv", "pass_data_pars":False},
-        ".npy": {"uri": "numpy::load", "pass_data_pars":False},
-        ".npz": {"uri": "np:load", "arg": {"allow_pickle": True}, "pass_data_pars":False},
-        ".pkl": {"uri": "dataloader::pickle_load", "pass_data_pars":False},
+        ".csv": {"uri": "mlmodels.dataloader::arrow_read_csv", "pass_data_pars":False},
+        ".npy": {"uri": "numpy::load", "arg": {"mmap_mode": "c"}, "pass_data_pars":False},
+        ".npz": {"uri": "numpy::load", "arg": {"allow_pickle": True}, "pass_data_pars":False},
+        ".pkl": {"uri": "mlmodels.dataloader::pickle_load", "pass_data_pars":False},
 
-        "image_dir": {"uri": "dataloader::image_dir_load", "pass_data_pars":False},
+        "npy_dir": {"uri": "mlmodels.dataloader::npy_dir_load", "pass_data_pars":False},
+        "image_dir": {"uri": "mlmodels.dataloader::image_dir_load", "pass_data_pars":False},
     }
+    _resolved_defaults  = {}   ### (loader uri, args) -> (loader_func, loader_args), filled lazily
     _validate_data_info = _validate_data_info
     _check_output_shape = _check_output_shape
+    _interpret_output   = _interpret_output
+    _interpret_stream_output = _interpret_stream_output
     
     def __init__(self, data_pars):
         self.final_output             = {}
         self.internal_states          = {}
+        self._data                    = None
         self.data_info                = data_pars['data_info']
         self.preprocessors            = data_pars.get('preprocessors', [])
+        self.generator                = self.data_info.get('generator', False)
+        self.batch_size               = int(self.data_info.get('batch_size', 1))
+        self.output                   = data_pars.get('output', {})
         # self.final_output_type        = data_pars['output_type']
 
 
@@ -249,7 +1047,7 @@ class DataLoader:
 
         for preprocessor in self.preprocessors:
             uri = preprocessor.get("uri", None)
-            if not uri:
+            if not uri and preprocessor.get("name", "") != "loader":
                 print(f"Preprocessor {preprocessor} missing uri")
 
 
@@ -265,65 +1063,75 @@ class DataLoader:
         if docheck :
             self.check()
 
+        out_tmp = self._run_preprocessors()
+        self.final_output = out_tmp
 
-        input_tmp = None
-        for preprocessor in self.preprocessors:
-            uri  = preprocessor["uri"]
-            args = preprocessor.get("args", {})
-            log("URL: ",uri, args)
-
-       
-            preprocessor_func = load_callable_from_uri(uri)
-            print("\n###### load_callable_from_uri LOADED",  preprocessor_func)
-            if inspect.isclass(preprocessor_func):
-                ### Should match PytorchDataloader, KerasDataloader, PandasDataset, ....
-                ## A class : muti-steps compute
-                cls_name = preprocessor_func.__name__
-                print("cls_name :", cls_name, flush=True)
+        if self.output:
+            self.final_output = self._interpret_output(self.output, out_tmp)
+        self._data = (self.final_output, self.internal_states)
 
 
-                if cls_name in DATASET_TYPES:  # dataset object
-                    obj_preprocessor = preprocessor_func(**args, data_info=self.data_info)
+    def _run_preprocessors(self):
+        ### All the stages, in order : returns the last stage output (a chunk iterator in generator mode)
+        input_tmp = None
+        for preprocessor in self.preprocessors:
+            if preprocessor.get("name", "") == "loader" and not preprocessor.get("uri", None):
+                ### Built-in file loader, resolved from default_loaders
+                out_tmp = self._load_data(preprocessor.get("args", {}))
 
+            elif self.generator and is_chunk_iterator(input_tmp):
+                ### Streaming mode : stage is applied lazily, chunk by chunk
+                out_tmp = self._stream_preprocessor(preprocessor, input_tmp)
 
-                    if cls_name == "pandasDataset" or cls_name == "NumpyDataset": # get dataframe/numpyarray instead of pytorch dataset
-                        out_tmp = obj_preprocessor.get_data()
-                    else:
-                        out_tmp = obj_preprocessor
+            else:
+                uri  = preprocessor["uri"]
+                args = preprocessor.get("args", {})
+                log("URL: ",uri, args)
 
+       
+                preprocessor_func = load_callable_from_uri(uri)
+                print("\n###### load_callable_from_uri LOADED",  preprocessor_func)
+                if inspect.isclass(preprocessor_func):
+                    ### Should match PytorchDataloader, KerasDataloader, PandasDataset, ....
+                    ## A class : muti-steps compute
+                    cls_name = preprocessor_func.__name__
+                    print("cls_name :", cls_name, flush=True)
 
-                else:  # pre-process object defined in preprocessor.py
-                    print("\n", "Object Creation")
-                    obj_preprocessor = preprocessor_func(**args)
 
-                    print("\n", "Object Compute")
-                    obj_preprocessor.compute(input_tmp)
+                    if cls_name in DATASET_TYPES:  # dataset object
+                        out_tmp = self._run_dataset_stage(preprocessor_func, args)
 
 
-                    print("\n", "Object get_data")                    
-                    out_tmp = obj_preprocessor.get_data()
+                    else:  # pre-process object defined in preprocessor.py
+                        fit_key = fit_cache_key(uri, args, input_tmp) if preprocessor.get("cache_fit", False) else None
+                        obj_fitted = fit_cache_get(fit_key)
+                        if obj_fitted is not None:
+                            print("\n", "Object fitted, from cache : transform")
+                            out_tmp = obj_fitted.transform(input_tmp)
 
+                        else:
+                            print("\n", "Object Creation")
+                            obj_preprocessor = preprocessor_func(**args)
 
+                            print("\n", "Object Compute")
+                            obj_preprocessor.compute(input_tmp)
 
-            else:
-                ### Only a function, not a Class : Directly COMPUTED.
 
-                # print("input_tmp: ",input_tmp['X'].shape,input_tmp['y'].shape)
-                # print("input_tmp: ",input_tmp.keys())
-                pos_params = inspect.getfullargspec(preprocessor_func)[0]
+                            print("\n", "Object get_data")                    
+                            out_tmp = obj_preprocessor.get_data()
 
-                print("\n ######### postional parameteres : ", pos_params)
-                print("\n ######### Execute : preprocessor_func", preprocessor_func)
+                            if fit_key is not None and hasattr(obj_preprocessor, "transform"):
+                                fit_cache_put(fit_key, obj_preprocessor, input_tmp, out_tmp)
 
-                if isinstance(input_tmp, (tuple, list)) and len(input_tmp) > 0 and len(pos_params) == 0:
-                    out_tmp = preprocessor_func(*input_tmp, **args)
 
-                elif pos_params == ['data_info']:
-                    log( f"function with postional parmater data_info {preprocessor_func} , (data_info, **args)")
-                    out_tmp = preprocessor_func(data_info=self.data_info, **args)
 
                 else:
-                    out_tmp = preprocessor_func(input_tmp, **args)
+                    ### Only a function, not a Class : Directly COMPUTED.
+
+                    # print("input_tmp: ",input_tmp['X'].shape,input_tmp['y'].shape)
+                    # print("input_tmp: ",input_tmp.keys())
+                    print("\n ######### Execute : preprocessor_func", preprocessor_func)
+                    out_tmp = self._run_function_stage(preprocessor_func, input_tmp, args)
 
 
 
@@ -335,10 +1143,139 @@ class DataLoader:
                         self.internal_states[internal_state] = out_tmp[internal_state]
 
             input_tmp = out_tmp
-        self.final_output = out_tmp
+        return input_tmp
+
+
+    def _load_data(self, args):
+        """
+          Built-in loader stage : {"name" : "loader", "args" : {"path" : ..., "file_type" : ...}}
+          Loader function is picked from default_loaders by file extension.
+          In generator mode, CSV is read as a chunk iterator of batch_size rows.
+          path can be a URL or a list of paths/URLs : see _load_data_async.
+        """
+        args          = dict(args)
+        path          = args.pop("path", self.data_info.get("data_path", ""))
+        file_type     = args.pop("file_type", None)
+        download_path = args.pop("download_path", self.data_info.get("download_path", "./"))
+
+        if isinstance(path, (list, tuple)):
+            return self._load_data_async(path, file_type, download_path, args)
+
+        if is_url(path):
+            return self._load_data_async([path], file_type, download_path, args)[0]
+
+        return self._load_file(path_norm(local_path(path)), file_type, args)
+
+
+    def _load_file(self, path, file_type, args):
+        if file_type is None:
+            if os.path.isdir(path):
+                file_type = "npy_dir" if any(f.endswith(".npy") for f in os.listdir(path)) else "image_dir"
+            else:
+                file_type = os.path.splitext(path)[1]
+
+        if file_type not in self.default_loaders:
+            raise Exception(f"No default loader for file type {file_type}")
+        ### Keyed on the loader spec : subclasses / instances overriding default_loaders get their own entry
+        spec = self.default_loaders[file_type]
+        key  = (spec["uri"], json.dumps(spec.get("arg", {}), sort_keys=True, default=str))
+        if key not in self._resolved_defaults:
+            self._resolved_defaults[key] = load_callable_from_dict(spec)
+        loader_func, loader_args = self._resolved_defaults[key]
+        loader_args = {**loader_args, **args}
+
+        if self.generator and file_type == ".csv":
+            loader_args["chunksize"] = self.batch_size
+
+        log("Loader: ", loader_func, path, loader_args)
+        data = loader_func(path, **loader_args)
+        if file_type == ".npz" and isinstance(data, np.lib.npyio.NpzFile):
+            data = LazyNpz(data)
+        return data
+
+
+    def _load_data_async(self, paths, file_type, download_path, args):
+        """
+          Download + load files in a thread pool, one task per path (interleave) :
+          download of one file overlaps with the parsing of the others.
+          Returns the loaded data as a tuple, in the order of paths : one output per file (case 1),
+          out_max_len / batching apply to the rows of each file.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        def fetch(path):
+            if is_url(path):
+                path = download_file(path, download_path)
+            return self._load_file(path_norm(local_path(path)), file_type, args)
+
+        ### Same path twice : loaded once, a URL is not downloaded twice into the same folder
+        unique    = list(dict.fromkeys(paths))
+        n_workers = min(len(unique), os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=max(n_workers, 1)) as executor:
+            loaded = dict(zip(unique, executor.map(fetch, unique)))
+        return tuple(loaded[path] for path in paths)
+
+
+    def _run_function_stage(self, preprocessor_func, input_tmp, args):
+        """
+          Calling rules of a function stage :
+            no positional parameter + tuple / list input --> func(*input, **args)
+            single positional parameter data_info       --> func(data_info=..., **args)
+            else                                         --> func(input, **args)
+        """
+        pos_params = inspect.getfullargspec(preprocessor_func)[0]
+        log("postional parameteres : ", pos_params)
+
+        if isinstance(input_tmp, (tuple, list)) and len(input_tmp) > 0 and len(pos_params) == 0:
+            return preprocessor_func(*input_tmp, **args)
+
+        if pos_params == ['data_info']:
+            log( f"function with postional parmater data_info {preprocessor_func} , (data_info, **args)")
+            return preprocessor_func(data_info=self.data_info, **args)
+
+        return preprocessor_func(input_tmp, **args)
+
+
+    def _run_dataset_stage(self, preprocessor_func, args):
+        obj_preprocessor = preprocessor_func(**args, data_info=self.data_info)
+        if preprocessor_func.__name__ in ("pandasDataset", "NumpyDataset"): # get dataframe/numpyarray instead of pytorch dataset
+            return obj_preprocessor.get_data()
+        return obj_preprocessor
+
+
+    def _stream_preprocessor(self, preprocessor, chunks):
+        """
+          Apply one preprocessor stage lazily over a chunk iterator.
+          Class stages are fitted with compute() on the first chunk,
+          next chunks go through transform() when available.
+        """
+        uri  = preprocessor["uri"]
+        args = preprocessor.get("args", {})
+        preprocessor_func = load_callable_from_uri(uri)
+
+        if not inspect.isclass(preprocessor_func):
+            return (self._run_function_stage(preprocessor_func, chunk, args) for chunk in chunks)
+
+        if preprocessor_func.__name__ in DATASET_TYPES:
+            ### Dataset objects read data_info, not the previous stage : same as compute()
+            return self._run_dataset_stage(preprocessor_func, args)
+
+        def stream():
+            obj_preprocessor = preprocessor_func(**args)
+            for i, chunk in enumerate(chunks):
+                if i > 0 and hasattr(obj_preprocessor, "transform"):
+                    yield obj_preprocessor.transform(chunk)
+                else:
+                    obj_preprocessor.compute(chunk)
+                    yield obj_preprocessor.get_data()
+        return stream()
+
 
     def get_data(self):
-        return self.final_output, self.internal_states
+        ### Built once per compute() : epoch loops calling get_data() get the same tuple back
+        if self._data is None:
+            self._data = (self.final_output, self.internal_states)
+        return self._data
 
 
 
@@ -483,6 +1420,410 @@ def test_dataloader(path='dataset/json/refactor/'):
           print("Error", f,  e)
 
 
+####################################################################################################
+###### Pipeline tests : small in-memory data, written to a temp folder by test_pipeline
+def _test_df(n=10):
+    return pd.DataFrame({"a": np.arange(n, dtype=np.float64), "b": np.arange(n) % 3, "y": np.arange(n) % 2})
+
+
+def _test_data(tmp_dir):
+    df = _test_df()
+    df.to_csv(os.path.join(tmp_dir, "data.csv"), index=False)
+    np.save(os.path.join(tmp_dir, "data.npy"), df.values)
+    np.savez(os.path.join(tmp_dir, "data.npz"), X=df[["a", "b"]].values, y=df["y"].values)
+    pickle_dump(df, path=os.path.join(tmp_dir, "data.pkl"))
+
+
+def _test_stage_xy(df, col_y="y"):
+    ### DataFrame --> (X, y) arrays
+    return df.drop(columns=[col_y]).values.astype(np.float64), df[col_y].values
+
+
+class _TestScaler:
+    n_fit = 0
+
+    def __init__(self, k=1.0):
+        self.k = k
+
+    def compute(self, x):
+        _TestScaler.n_fit += 1
+        self.mean = x.mean(axis=0)
+        self.out  = self.transform(x)
+
+    def transform(self, x):
+        return (x - self.mean) * self.k
+
+    def get_data(self):
+        return self.out
+
+
+class _TestScalerPair(_TestScaler):
+    ### Output also kept in another attribute, get_data() builds a new tuple on each call
+    def compute(self, x):
+        super().compute(x)
+        self.backup = self.out[0].copy()
+
+    def transform(self, x):
+        x = super().transform(x)
+        return x, -x
+
+    def get_data(self):
+        return self.out[0], self.out[1]
+
+
+class _TestScalerSample(_TestScaler):
+    ### get_data() != transform() : breaks the cache_fit contract
+    def get_data(self):
+        return self.out[:5]
+
+
+def _test_loader(path, *stages, **data_pars):
+    data_pars = {"data_info": data_pars.pop("data_info", {}),
+                 "preprocessors": [{"name": "loader", "args": {"path": path}}, *stages], **data_pars}
+    loader = DataLoader(data_pars)
+    loader.compute()
+    return loader.get_data()[0]
+
+
+def test_loader_stage(tmp_dir):
+    df = _test_df()
+
+    out = _test_loader(os.path.join(tmp_dir, "data.csv"))
+    assert out.shape == df.shape and (out.values == df.values).all()
+
+    out = _test_loader(os.path.join(tmp_dir, "data.pkl"))
+    assert out.equals(df)
+
+    out = _test_loader("file://" + os.path.join(tmp_dir, "data.pkl"))
+    assert out.equals(df)
+
+    try:
+        _test_loader("s3://bucket/data.csv")
+        raise AssertionError("s3 URL read as a local path")
+    except Exception as e:
+        assert "not supported" in str(e)
+
+    try:
+        _test_loader(os.path.join(tmp_dir, "data.txt"))
+        raise AssertionError("file without default loader accepted")
+    except Exception as e:
+        assert "No default loader" in str(e)
+
+
+def test_stream(tmp_dir):
+    path   = os.path.join(tmp_dir, "data.csv")
+    info   = {"generator": True, "batch_size": 4}
+    stages = [{"uri": "mlmodels.dataloader::_test_stage_xy"}]
+
+    out = _test_loader(path, *stages, data_info=info)
+    assert is_chunk_iterator(out)
+    assert [len(X) for X, y in out] == [4, 4, 2]
+
+    ### Same calling rules as compute() : the (X, y) chunk is unpacked into split_train_test
+    split = {"uri": "mlmodels.dataloader::split_train_test", "args": {"test_size": 0.5, "random_state": 0}}
+    out = _test_loader(path, *stages, split, data_info=info)
+    assert [(len(X_train), len(X_test), len(y_test)) for X_train, X_test, y_train, y_test in out] == [(2, 2, 2)] * 2 + [(1, 1, 1)]
+
+
+def test_mmap_load(tmp_dir):
+    df = _test_df()
+
+    out = _test_loader(os.path.join(tmp_dir, "data.npy"))
+    assert isinstance(out, np.memmap) and (out == df.values).all()
+    out[0, 0] = -1   ### Copy-on-write map : the file is unchanged
+    assert np.load(os.path.join(tmp_dir, "data.npy"))[0, 0] == 0
+
+    out = _test_loader(os.path.join(tmp_dir, "data.npz"))
+    assert get_output_case(out) == 3 and list(out) == ["X", "y"] and (out["y"] == out[1]).all()
+
+
+def test_load_async(tmp_dir):
+    df    = _test_df()
+    paths = [os.path.join(tmp_dir, "data.npy"), os.path.join(tmp_dir, "data.pkl")]
+
+    out = _test_loader(paths)
+    assert isinstance(out, tuple) and len(out) == 2 and out[1].equals(df)
+
+    ### One output per file : out_max_len trims the rows of each file, not the list of files
+    out = _test_loader([paths[0], paths[0]], output={"out_max_len": 4})
+    assert get_output_case(out) == 1 and [len(a) for a in out] == [4, 4]
+
+    import importlib.util
+    if importlib.util.find_spec("cli_code") is None:
+        return
+    ### URLs ending with the same file name, served from tmp_dir by a local HTTP server
+    import functools, http.server
+    for folder, n in (("a", 3), ("b", 10)):
+        os.makedirs(os.path.join(tmp_dir, folder))
+        pickle_dump(df.head(n), path=os.path.join(tmp_dir, folder, "data.pkl"))
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=tmp_dir)
+    server  = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        urls = [f"http://127.0.0.1:{server.server_port}/{folder}/data.pkl?dl=1" for folder in ("a", "b")]
+        info = {"download_path": os.path.join(tmp_dir, "download")}
+        out  = _test_loader(urls, data_info=info)
+        assert out[0].equals(df.head(3)) and out[1].equals(df)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    ### Finished downloads are reused, the server is gone
+    out = _test_loader(urls, data_info=info)
+    assert out[0].equals(df.head(3)) and out[1].equals(df)
+
+
+def test_prefetch(tmp_dir):
+    path   = os.path.join(tmp_dir, "data.csv")
+    stages = [{"uri": "mlmodels.dataloader::_test_stage_xy"}]
+
+    out = _test_loader(path, *stages, data_info={"batch_size": 4}, output={"format": "generic_generator", "out_max_len": 8})
+    assert isinstance(out, PrefetchGenerator) and [len(X) for X, y in out] == [4, 4]
+
+    out = _test_loader(path, *stages, data_info={"generator": True, "batch_size": 4}, output={"format": "generic_generator"})
+    assert [len(y) for X, y in out] == [4, 4, 2]
+
+    try:
+        import torch
+    except ImportError:
+        torch = None
+    if torch is not None:
+        out = _test_loader(path, *stages, data_info={"batch_size": 4}, output={"format": "tchDataLoader", "num_workers": 2})
+        assert out.num_workers == 2 and [len(X) for X, y in out] == [4, 4, 2]
+
+    ### Consumer stops early : close() ends the background thread
+    out = _test_loader(path, *stages, data_info={"batch_size": 1}, output={"format": "generic_generator", "prefetch": 1})
+    next(out)
+    out.close()
+    assert not out._thread.is_alive() and list(out) == []
+
+
+def test_batch_generator(tmp_dir):
+    df   = _test_df()
+    X, y = _test_stage_xy(df)
+
+    batches = list(batch_generator((X, y), 4))
+    assert [len(b[0]) for b in batches] == [4, 4, 2] and np.shares_memory(batches[1][0], X)
+
+    ### Mixed tuple : DataFrame rows sliced by position
+    batches = list(batch_generator((df.set_index(df.index + 100), y), 4))
+    assert [len(b[0]) for b in batches] == [4, 4, 2] and (batches[2][0]["a"].values == X[8:, 0]).all()
+
+
+def test_split(tmp_dir):
+    stages = [{"uri": "mlmodels.dataloader::_test_stage_xy"},
+              {"uri": "mlmodels.dataloader::split_train_test",
+               "args": {"test_size": 0.5, "stratify": True, "random_state": 0}}]
+    X_train, X_test, y_train, y_test = _test_loader(os.path.join(tmp_dir, "data.csv"), *stages)
+    assert len(X_train) == len(X_test) == 5 and y_test.sum() in (2, 3)
+
+    again = _test_loader(os.path.join(tmp_dir, "data.csv"), *stages)
+    assert (again[1] == X_test).all()
+
+    ### Cached indices are shared : read-only
+    train_idx, test_idx = _compute_split_indices(100, 0.5, random_state=0)
+    try:
+        train_idx[0] = -1
+        raise AssertionError("cached split indices are writable")
+    except ValueError:
+        pass
+
+    ### Rows taken by position, for each container type
+    from scipy import sparse
+    X_df = pd.DataFrame({"a": np.arange(10)}, index=np.arange(10)[::-1])
+    X_train, X_test, X_sp_train, X_sp_test, l_train, l_test = split_train_test(
+        X_df, sparse.coo_matrix(np.arange(10).reshape(-1, 1)), list(range(10)), test_size=0.3, random_state=0)
+    assert list(X_test["a"]) == X_sp_test.toarray()[:, 0].tolist() == l_test and len(l_train) == 7
+
+    ### RandomState instance : new split on each call, as train_test_split
+    X, y = np.arange(100), np.arange(100) % 2
+    rs   = np.random.RandomState(0)
+    assert (split_train_test(X, y, random_state=rs)[1] != split_train_test(X, y, random_state=rs)[1]).any()
+
+
+def test_arrow_csv(tmp_dir):
+    ### Same DataFrame as pandas.read_csv : dates, times, hex numbers, empty and int columns with NA
+    path = os.path.join(tmp_dir, "types.csv")
+    with open(path, "w") as f:
+        f.write(",a,a,date,time,hex,empty,na\n0,1,x,2020-01-01,12:30:00,0x10,,1\n1, 2,y,2020-01-02,13:00:00,0x1F,,NA\n")
+    pd.testing.assert_frame_equal(arrow_read_csv(path), pd.read_csv(path))
+
+    ### Quoted header with a newline, newline in a value
+    with open(path, "w") as f:
+        f.write('"x\ny",b\n"p\nq",2\n3,4\n')
+    pd.testing.assert_frame_equal(arrow_read_csv(path), pd.read_csv(path))
+
+    ### Later block with a float : int column of the first block becomes float64
+    with open(path, "w") as f:
+        f.write("a\n" + "".join(f"{i}\n" for i in range(1000)) + "1.5\n")
+    pd.testing.assert_frame_equal(arrow_read_csv(path, block_size=1024), pd.read_csv(path))
+
+
+def test_tf_output(tmp_dir):
+    try:
+        import tensorflow as tf
+    except ImportError:
+        return
+    path   = os.path.join(tmp_dir, "data.csv")
+    stages = [{"uri": "mlmodels.dataloader::_test_stage_xy"}]
+    info   = {"batch_size": 4}
+
+    out = _test_loader(path, *stages, data_info=info, output={"format": "tfDataset"})
+    assert isinstance(out, tf.data.Dataset) and [int(X.shape[0]) for X, y in out] == [4, 4, 2]
+
+    ### Above tf_max_bytes : batches streamed from_generator, DataFrame outputs too
+    out = _test_loader(path, *stages, data_info=info, output={"format": "tfDataset", "tf_max_bytes": 0})
+    assert [int(X.shape[0]) for X, y in out] == [4, 4, 2]
+    assert output_nbytes(_test_df()) == 3 * 10 * 8
+    out = _test_loader(path, data_info=info, output={"format": "tfDataset", "tf_max_bytes": 0})
+    assert [tuple(x.shape) for x in out] == [(4, 3), (4, 3), (2, 3)]
+
+    ### Generator mode : the stream is re-opened for each epoch
+    out = _test_loader(path, *stages, data_info={"generator": True, "batch_size": 4}, output={"format": "tfDataset"})
+    for epoch in range(2):
+        assert [int(X.shape[0]) for X, y in out] == [4, 4, 2]
+
+
+def test_tch_output(tmp_dir):
+    try:
+        import torch
+    except ImportError:
+        return
+    path   = os.path.join(tmp_dir, "data.csv")
+    stages = [{"uri": "mlmodels.dataloader::_test_stage_xy"}]
+    info   = {"batch_size": 4}
+
+    out = _test_loader(path, *stages, data_info=info, output={"format": "tchDataset"})
+    assert isinstance(out, torch.utils.data.TensorDataset) and len(out) == 10 and out[0][0].shape == (2,)
+
+    out = _test_loader(path, *stages, data_info=info, output={"format": "tchDataLoader"})
+    assert [len(X) for X, y in out] == [4, 4, 2]
+
+    ### Shares the numpy buffer, read-only arrays are copied
+    X = np.arange(6.0).reshape(3, 2)
+    assert to_torch_tensor(X).data_ptr() == X.ctypes.data
+    X.flags.writeable = False
+    assert to_torch_tensor(X).data_ptr() != X.ctypes.data
+
+
+def test_save(tmp_dir):
+    path   = os.path.join(tmp_dir, "data.csv")
+    stages = [{"uri": "mlmodels.dataloader::_test_stage_xy"}]
+
+    X, y = _test_loader(path, *stages, output={"path": os.path.join(tmp_dir, "out.npz"), "out_max_len": 8})
+    out  = _test_loader(os.path.join(tmp_dir, "out.npz"))
+    assert len(X) == 8 and (out["arr_0"] == X).all() and (out["arr_1"] == y).all()
+
+    _test_loader(path, *stages, output={"path": [os.path.join(tmp_dir, "X.npy"), os.path.join(tmp_dir, "y.npy")]})
+    assert len(_test_loader(os.path.join(tmp_dir, "y.npy"))) == 10
+
+    ### Shape mismatch : nothing saved
+    try:
+        _test_loader(path, *stages, output={"path": os.path.join(tmp_dir, "bad.npz"), "shape": [(2,), (1,)]})
+        raise AssertionError("shape mismatch accepted")
+    except Exception as e:
+        assert "does not match" in str(e) and not os.path.exists(os.path.join(tmp_dir, "bad.npz"))
+
+
+def test_save_npy_dir(tmp_dir):
+    ### Folder of .npy, explicit and above SAVE_MAX_BYTES, reloaded memory-mapped by the npy_dir loader
+    global SAVE_MAX_BYTES
+    path   = os.path.join(tmp_dir, "data.csv")
+    stages = [{"uri": "mlmodels.dataloader::_test_stage_xy"}]
+
+    X, y = _test_loader(path, *stages, output={"path": os.path.join(tmp_dir, "out_dir.npz"), "save_format": "npy_dir"})
+    save_max_bytes, SAVE_MAX_BYTES = SAVE_MAX_BYTES, 0
+    try:
+        _test_loader(path, *stages, output={"path": os.path.join(tmp_dir, "out_big.npz")})
+    finally:
+        SAVE_MAX_BYTES = save_max_bytes
+    for folder in ("out_dir", "out_big"):
+        out = _test_loader(os.path.join(tmp_dir, folder))
+        assert isinstance(out["arr_0"], np.memmap) and (out["arr_0"] == X).all() and (out["arr_1"] == y).all()
+
+
+def test_mmap_output(tmp_dir):
+    path = os.path.join(tmp_dir, "data.npy")
+
+    out = _test_loader(path, output={"format": "tchDataset", "raw_mmap": True})
+    assert isinstance(out, np.memmap)
+
+    import importlib.util
+    if importlib.util.find_spec("torch") is None:
+        return
+    out = _test_loader(path, output={"format": "tchDataset"})
+    assert len(out) == 10 and not out.tensors[0].is_pinned()
+
+    ### Read-only map (mmap_mode="r") : copied, in-place ops are safe
+    t = to_torch_tensor(np.load(path, mmap_mode="r"))
+    t.add_(1)
+    assert np.load(path)[0, 0] == 0 and float(t[0, 0]) == 1
+
+
+def test_dtype(tmp_dir):
+    path   = os.path.join(tmp_dir, "data.csv")
+    stages = [{"uri": "mlmodels.dataloader::_test_stage_xy"}]
+
+    out = _test_loader(path, *stages, output={"shape": [(2,), ()], "dtype": "float16", "label_outputs": [1]})
+    assert out[0].dtype == np.float16 and out[1].dtype == np.int8
+
+    out = _test_loader(os.path.join(tmp_dir, "data.npy"), output={"dtype": "float16", "out_max_len": 4})
+    assert type(out) is np.ndarray and out.dtype == np.float16 and len(out) == 4
+
+    import importlib.util
+    if importlib.util.find_spec("torch") is None or importlib.util.find_spec("ml_dtypes") is None:
+        return
+    import torch
+    for output_format in ("tchDataset", "tchDataLoader"):
+        out = _test_loader(path, *stages, data_info={"batch_size": 4}, output={"format": output_format, "dtype": "bfloat16"})
+        X   = out.tensors[0] if output_format == "tchDataset" else next(iter(out))[0]
+        assert X.dtype == torch.bfloat16 and float(X[1, 0]) == 1.0
+
+
+def test_fit_cache(tmp_dir):
+    path  = os.path.join(tmp_dir, "data.npy")
+    stage = {"uri": "mlmodels.dataloader::_TestScaler", "args": {"k": 2.0}, "cache_fit": True}
+
+    n_fit = _TestScaler.n_fit
+    for _ in range(3):
+        X = _test_loader(path, stage)
+    assert _TestScaler.n_fit == n_fit + 1 and abs(X.mean()) < 1e-9
+
+    ### Cached copy keeps the fitted state only, not the transformed data
+    assert all(not hasattr(obj, "out") for obj in _fit_cache.values() if isinstance(obj, _TestScaler))
+
+    _test_loader(path, {**stage, "cache_fit": False})
+    assert _TestScaler.n_fit == n_fit + 2
+
+    ### Per-row data held in other attributes / fresh tuples is dropped too
+    stage = {**stage, "uri": "mlmodels.dataloader::_TestScalerPair"}
+    X, X_neg = _test_loader(path, stage)
+    X, X_neg = _test_loader(path, stage)
+    assert _TestScaler.n_fit == n_fit + 3 and (X == -X_neg).all()
+    obj = [obj for obj in _fit_cache.values() if isinstance(obj, _TestScalerPair)][0]
+    assert not hasattr(obj, "out") and not hasattr(obj, "backup") and hasattr(obj, "mean")
+
+    ### get_data() != transform() : never cached, same output as without cache
+    stage = {**stage, "uri": "mlmodels.dataloader::_TestScalerSample"}
+    for _ in range(2):
+        assert len(_test_loader(path, stage)) == 5
+    assert _TestScaler.n_fit == n_fit + 5
+    assert not any(isinstance(obj, _TestScalerSample) for obj in _fit_cache.values())
+
+
+TESTS_PIPELINE = [test_loader_stage, test_stream, test_mmap_load, test_load_async, test_prefetch, test_batch_generator,
+                  test_split, test_arrow_csv, test_tf_output, test_tch_output, test_save, test_save_npy_dir,
+                  test_mmap_output, test_dtype, test_fit_cache]
+
+def test_pipeline():
+    print("\n\n\n###### Test pipeline  ###############################################################")
+    for test in TESTS_PIPELINE:
+        print("\n", "#" * 5, test.__name__)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            _test_data(tmp_dir)
+            test(tmp_dir)
+
+
 ####################################################################################################
 def cli_load_arguments(config_file=None):
     """
@@ -531,6 +1872,9 @@ def main():
     if arg.do == "test_single":
         test_single(arg)  
 
+    if arg.do == "test_pipeline":
+        test_pipeline()
+
 
 if __name__ == "__main__":
    VERBOSE =1  
@@ -8,7 +8,7 @@ from pathlib import Path
 import json
 
 import importlib
-from inspect import getmembers
+from functools import lru_cache
 
 
 ####################################################################################################
@@ -638,7 +638,9 @@ def load_function(package="mlmodels.util", name="path_norm"):
 
 
 
+@lru_cache(maxsize=256)
 def load_callable_from_uri(uri):
+    ### uri are immutable config strings : resolved once, then a hash lookup
     assert(len(uri)>0 and ('::' in uri or '.' in uri))
     if '::' in uri:
         module_path, callable_name = uri.split('::')
@@ -651,7 +653,7 @@ def load_callable_from_uri(uri):
         spec.loader.exec_module(module)
     else:
         module = importlib.import_module(module_path)
-    return dict(getmembers(module))[callable_name]
+    return getattr(module, callable_name)
         
 
 def load_callable_from_dict(function_dict, return_other_keys=False):